@@ -23,20 +23,29 @@
 import base64
 import collections
 import datetime
+import functools
 import glob
 import hashlib
 import html
+import io
+import operator
 import os
 import os.path
-import json
 import re
 import random
 import shelve
 import subprocess
+import tarfile
+import tempfile
+import warnings
+import zipfile
+from multiprocessing import Pool
 
 import tqdm
-import bleach
+import nh3
+import orjson
 import lxml.etree
+import lxml.html
 import html5lib
 
 from utils import make_link
@@ -57,24 +66,29 @@ def read_reports_metadata():
     # Load the report version JSON metadata which is by report-version
     # and collate by report. We get report version JSON data from three
     # sources.
-    reports = collections.defaultdict(lambda : [])
-    load_crs_dot_gov_reports(reports, withheld_reports)
-    load_crsreports_dot_congress_dot_gov_reports(reports)
-    load_unt_reports(reports)
-    load_fas_reports(reports)
+    # Alongside the reports, track the dates of the versions we have for each
+    # report so that duplicate versions (the same report on the same date),
+    # including across sources, can be skipped.
+    reports = collections.defaultdict(list)
+    seen_dates = collections.defaultdict(set)
+    load_crs_dot_gov_reports(reports, seen_dates, withheld_reports)
+    load_crsreports_dot_congress_dot_gov_reports(reports, seen_dates)
+    load_unt_reports(reports, seen_dates)
+    load_fas_reports(reports, seen_dates)
 
     # For each report, sort the report version records in reverse-chronological order, putting
     # the most recent one first. Sort on the report date and on the retrieved date, since the
     # cover date is a date (without time) and if there are multiple updates on the same
     # date we should take the most recent fetch as the newer one.
+    version_sort_key = operator.itemgetter('date', 'retrieved')
     for report in reports.values():
-        report.sort(key = lambda record : (record['date'], record['retrieved']), reverse=True)
+        report.sort(key = version_sort_key, reverse=True)
 
     # Sort the reports in reverse chronological order by most recent
     # report version (based on the first version record, since the
     # arrays have already been sorted).
     reports = list(reports.items())
-    reports.sort(key = lambda kv : (kv[1][0]['date'], kv[1][0]['retrieved']), reverse=True)
+    reports.sort(key = lambda kv : version_sort_key(kv[1][0]), reverse=True)
 
     # Transform to the public metadata format.
     reports = [
@@ -94,9 +108,12 @@ def write_reports_metadata(reports):
         # Remember it so we can delete orphaned files.
         all_files.add(out_fn)
 
-        # Write it out.
-        with open(out_fn, "w") as f2:
-            f2.write(json.dumps(report, indent=2))
+        # Write it out. Serialize straight to bytes with orjson, and write to a
+        # temporary file that replaces the old file only once it is complete
+        # so that an interrupted run doesn't leave a truncated file behind.
+        with open(out_fn + ".tmp", "wb") as f2:
+            f2.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+        os.replace(out_fn + ".tmp", out_fn)
 
 
     # Delete orphaned files.
@@ -109,7 +126,7 @@ def write_reports_metadata(reports):
     return reports
 
 
-def load_crs_dot_gov_reports(reports, withheld_reports):
+def load_crs_dot_gov_reports(reports, seen_dates, withheld_reports):
     # Load all of the CRS report version metadata that was submitted through
     # our inside-the-Capitol scraper. Add each report version into the reports
     # dictionary that is keyed by the report ID (not the report version ID).
@@ -117,13 +134,10 @@ def load_crs_dot_gov_reports(reports, withheld_reports):
     print("Reading CRS.gov report metadata...")
 
     # Scan the "incoming" directory for report version metadata...
-    for fn in sorted(glob.glob(os.path.join(INCOMING_DIR, "documents/*.json"))):
-        with open(fn) as f:
-            try:
-                doc = json.load(f)
-            except ValueError as e:
-                print(fn, e)
-                continue
+    for fn in list_json_files(os.path.join(INCOMING_DIR, "documents")):
+        doc = load_json_file(fn)
+        if doc is None:
+            continue
 
         # Skip document types that we have access to but do not want to
         # expose publicly.
@@ -137,93 +151,136 @@ def load_crs_dot_gov_reports(reports, withheld_reports):
             continue
 
         # Turn this into our public metadata format.
-        rec = collections.OrderedDict([
-            ("source", "EveryCRSReport.com"),
-            ("id", doc["PrdsProdVerId"]), # report version ID, which changes with each version
+        rec = {
+            "source": "EveryCRSReport.com",
+            "id": doc["PrdsProdVerId"], # report version ID, which changes with each version
 
             # Validate and normalize the fetch date and CoverDate into an ISO date string.
             # We need these for chronological sorting but turning them into datetime instances
             # would break JSON serialization. (TODO: Probably want to strip the time from
             # CoverDate and treat it as timezoneless, and probably want to add a UTC indication
             # to _fetched.)
-            ('date', datetime.datetime.strptime(doc['CoverDate'], "%Y-%m-%dT%H:%M:%S").date().isoformat()),
-            ('retrieved', datetime.datetime.strptime(doc['_fetched'], "%Y-%m-%dT%H:%M:%S.%f").isoformat()),
+            'date': normalize_cover_date(doc['CoverDate']),
+            'retrieved': normalize_fetched_date(doc['_fetched']),
 
-            ("title", doc["Title"]), # title
-            ("summary", doc.get("Summary", "").strip()) or None, # summary, sometimes not present - set to None if not a non-empty string
+            "title": doc["Title"], # title
+            "summary": doc.get("Summary", "").strip(), # summary, sometimes not present
 
-            ("type", doc['ProdTypeDisplayName']),
-            ("typeId", doc['ProdTypeGroupCode']),
-            ("active", doc["StatusFlag"] == "Active"), # "Active" or "Archived", not sure if it's meaningful
+            "type": doc['ProdTypeDisplayName'],
+            "typeId": doc['ProdTypeGroupCode'],
+            "active": doc["StatusFlag"] == "Active", # "Active" or "Archived", not sure if it's meaningful
 
-            ("formats", [
-                collections.OrderedDict([
-                    ("format", f["FormatType"]), # "PDF" or "HTML"
+            "formats": [
+                {
+                    "format": f["FormatType"], # "PDF" or "HTML"
 
                     # these fields we inserted when we scraped the content
-                    ("encoding", f["_"]["encoding"]), # best guess at encoding of HTML content
-                    ("url", f["_"]["url"]), # the URL we fetched the file from
-                    ("sha1", f["_"]["sha1"]), # the SHA-1 hash of the file content
-                    ("filename", f["_"]["filename"]), # the path where the content is stored in our cache
-                    ("images", f["_"]["images"] if "images" in f["_"] else None), # mapped image paths found in the HTML file (this could be omitted from the public files but we need it in a later step of processing)
-                ])
+                    "encoding": f["_"]["encoding"], # best guess at encoding of HTML content
+                    "url": f["_"]["url"], # the URL we fetched the file from
+                    "sha1": f["_"]["sha1"], # the SHA-1 hash of the file content
+                    "filename": f["_"]["filename"], # the path where the content is stored in our cache
+                    "images": f["_"]["images"] if "images" in f["_"] else None, # mapped image paths found in the HTML file (this could be omitted from the public files but we need it in a later step of processing)
+                }
                 for f in sorted(doc["FormatList"], key = lambda ff : ff["Order"])
-                ]),
-            ("topics", # there's no indication that the PrdsCliItemId has a clash between the two types (IBCList, CongOpsList)
-                [collections.OrderedDict([("source", "IBCList"), ("id", int(entry["PrdsCliItemId"])), ("name", entry["CliTitle"]) ]) for entry in doc["IBCList"]]
-              + [collections.OrderedDict([("source", "CongOpsList"), ("id", int(entry["PrdsCliItemId"])), ("name", entry["CliTitle"]) ]) for entry in doc["CongOpsList"]]
+                ],
+            "topics": ( # there's no indication that the PrdsCliItemId has a clash between the two types (IBCList, CongOpsList)
+                [{ "source": "IBCList", "id": int(entry["PrdsCliItemId"]), "name": entry["CliTitle"] } for entry in doc["IBCList"]]
+              + [{ "source": "CongOpsList", "id": int(entry["PrdsCliItemId"]), "name": entry["CliTitle"] } for entry in doc["CongOpsList"]]
                 ), # TODO: ChildIBCs?
-        ])
+        }
 
         # Check that we don't have this version already - sometimes we have multiple
         # scrapes on the same date.
-        for v in reports[doc['ProductNumber']]:
-            if v["date"] == rec["date"]:
-                # There's already a document for this date.
-                break
-        else:
-            # This record is new.
-            # Store by report number.
-            reports[doc['ProductNumber']].append(rec)
+        if rec["date"][:10] in seen_dates[doc['ProductNumber']]:
+            # There's already a document for this date.
+            continue
+
+        # This record is new.
+        # Store by report number.
+        seen_dates[doc['ProductNumber']].add(rec["date"][:10])
+        reports[doc['ProductNumber']].append(rec)
+
+# The same cover dates occur in many report version records, so the
+# normalized forms are cached. fromisoformat is implemented in C and is much
+# faster than strptime.
+@functools.lru_cache(maxsize=4096)
+def normalize_cover_date(s):
+    return datetime.datetime.fromisoformat(s).date().isoformat()
+
+def normalize_fetched_date(s):
+    return datetime.datetime.fromisoformat(s).isoformat()
+
+def list_json_files(dirname):
+    # List the paths of the .json files in a directory, sorted by name. The
+    # entries from os.scandir come with their file type, so picking out the
+    # regular files doesn't take a stat() call per file. Like glob, skip
+    # dot-files, and treat a missing directory as empty.
+    try:
+        with os.scandir(dirname) as entries:
+            return sorted(
+                entry.path for entry in entries
+                if entry.name.endswith(".json") and not entry.name.startswith(".") and entry.is_file()
+            )
+    except FileNotFoundError:
+        return []
+
+def load_json_file(fn):
+    # Parse a JSON file, returning None if it isn't valid JSON.
+    with open(fn, "rb") as f:
+        try:
+            return orjson.loads(f.read())
+        except ValueError as e:
+            print(fn, e)
+            return None
+
+def write_new_file(fn, read_content):
+    # Write a file unless it already exists, getting its content by calling
+    # read_content only if it doesn't. Opening the file in "x" mode checks for
+    # and creates the file in a single call, rather than a stat() first. If
+    # getting the content fails, don't leave an empty file behind.
+    try:
+        f = open(fn, "xb")
+    except FileExistsError:
+        return
+    with f:
+        try:
+            f.write(read_content())
+        except:
+            os.unlink(fn)
+            raise
 
-def load_unt_reports(reports):
+def load_unt_reports(reports, seen_dates):
     # Scan the University of North Texas archive for report metadata...
     if not os.path.exists(UNT_ARCHIVE): return
 
-    import tarfile
-
     print("Reading UNT report metadata...")
 
     with tarfile.open(UNT_ARCHIVE) as untarchive:
      with shelve.open(UNT_ARCHIVE+"_hashes.db") as hashcache:
-        # Read the entire tar directory. We'll need it a few times, and since
-        # extracting PDFs is expensive we want to know how many items we have
-        # in total so we can show a progress meter.
-        tardir = []
+        # Read the entire tar directory in one pass, mapping directories to
+        # the name of the PDF file within them, since the PDF filename is not
+        # predictable, and collecting the XML metadata records.
+        directory_pdf_name = { }
+        xml_records = []
         while True:
             fi = untarchive.next()
             if fi is None: break
-            tardir.append(fi)
-
-        # Do a first pass, mapping directories to the name of the PDF file
-        # within them, since the PDF filename is not predictable.
-        directory_pdf_name = { }
-        for fi in tardir:
-            if fi.name.endswith(".pdf"):
-                p = fi.name.split("/")
-                directory_pdf_name["/".join(p[:-1])] = fi.name
-
-        # Do a third pass locating XML metadata records and corresponding PDFs.
+            name = fi.name
+            if name.endswith(".pdf"):
+                directory_pdf_name[name.rpartition("/")[0]] = name
+            elif name.endswith(".xml") and not name.endswith(".pro.xml"): # .pro.xml is some other metadata stuff
+                xml_records.append(fi)
+
+        # Match XML metadata records to their PDFs. Since extracting PDFs is
+        # expensive we want to know how many items we have in total so we can
+        # show a progress meter.
         unt_reports = []
-        for fi in tardir:
-            if not fi.name.endswith(".xml"): continue
-            if fi.name.endswith(".pro.xml"): continue # some other metadata stuff
-            fi_dirname = "/".join(fi.name.split("/")[:-1])
-            pdf_fn = directory_pdf_name.get(fi_dirname)
+        for fi in xml_records:
+            pdf_fn = directory_pdf_name.get(fi.name.rpartition("/")[0])
             if not pdf_fn: continue # no PDF here
             unt_reports.append((fi, pdf_fn))
 
-        # Do a fourth pass creating metadata records.
+        # Do a final pass creating metadata records.
         existing_reports = set(reports.keys())
         num_new_reports = 0
         num_new_versions = 0
@@ -287,32 +344,32 @@ def load_unt_reports(reports):
 
             # Create the metadata record for this report version.
             try:
-                rec = collections.OrderedDict([
-                    ("source", UNT_SOURCE_STRING),
-                    ("sourceLink", "https://digital.library.unt.edu/" + getvalue("meta", "ark") + "/"),
-                    ("id", report_version_id),
-                    ("date", report_date),
-                    ("retrieved", getvalue("meta", "metadataCreationDate").replace(", ", "T")), # not ISO format originally but this fix seems to work, don't know what time zone though
-                    ("title", getvalue("title", "officialtitle", True)),
-                    ("summary", getvalue("description", "content", False, False)),
-                    ("type", "CRS Report"), # title[qualifier=seriestitle] is sometimes "Legal Sidebar" but other values are weird
-                    ("typeId", "REPORT"),
-                    ("active", False),
-                    ("formats", [
-                        collections.OrderedDict([
-                            ("format", "PDF"),
-                            ("filename", pdf_fn),
-                        ])
-                        ]),
-                    ("topics", # there's no indication that the PrdsCliItemId has a clash between the two types (IBCList, CongOpsList)
-                        [collections.OrderedDict([
-                            ("source", subject.get("qualifier")),
-                            ("id", subject.text),
-                            ("name", subject.text)
-                            ])
-                            for subject in md.findall("subject")]
-                        ),
-                ])
+                rec = {
+                    "source": UNT_SOURCE_STRING,
+                    "sourceLink": "https://digital.library.unt.edu/" + getvalue("meta", "ark") + "/",
+                    "id": report_version_id,
+                    "date": report_date,
+                    "retrieved": getvalue("meta", "metadataCreationDate").replace(", ", "T"), # not ISO format originally but this fix seems to work, don't know what time zone though
+                    "title": getvalue("title", "officialtitle", True),
+                    "summary": getvalue("description", "content", False, False),
+                    "type": "CRS Report", # title[qualifier=seriestitle] is sometimes "Legal Sidebar" but other values are weird
+                    "typeId": "REPORT",
+                    "active": False,
+                    "formats": [
+                        {
+                            "format": "PDF",
+                            "filename": pdf_fn,
+                        }
+                        ],
+                    "topics": [ # there's no indication that the PrdsCliItemId has a clash between the two types (IBCList, CongOpsList)
+                        {
+                            "source": subject.get("qualifier"),
+                            "id": subject.text,
+                            "name": subject.text
+                        }
+                        for subject in md.findall("subject")
+                        ],
+                }
 
             except ValueError as e:
                 # TODO: Not all of the metadata provides all of the data values
@@ -331,36 +388,35 @@ def load_unt_reports(reports):
             # we have a version for this document with the same date.
             if report_number not in existing_reports and report_number not in reports:
                 num_new_reports += 1
-            is_dup = False
-            for v in reports[report_number]:
-                if v["date"][:10] == rec["date"][:10]:
-                    # There's already a document for this date.
-                    # We seem to have duplicates within the UNT archive
-                    # and of course also across collections.
-                    is_dup = True
-                    break
-
-            if is_dup:
+            if rec["date"][:10] in seen_dates[report_number]:
+                # There's already a document for this date.
+                # We seem to have duplicates within the UNT archive
+                # and of course also across collections.
                 continue
 
             # This record is new.
             if report_number in existing_reports:
                 num_new_versions += 1
+            seen_dates[report_number].add(rec["date"][:10])
             reports[report_number].append(rec)
 
             # Save PDF file. We may or may not have read it earlier.
             pdf_fn = os.path.join(REPORTS_DIR, pdf_fn)
-            if not os.path.exists(pdf_fn):
-                if pdf_content is None:
-                    with untarchive.extractfile(pdf_src_fn) as f1:
-                        pdf_content = f1.read()
-                with open(pdf_fn, "wb") as f:
-                    f.write(pdf_content)
+            def read_pdf():
+                if pdf_content is not None:
+                    return pdf_content
+                with untarchive.extractfile(pdf_src_fn) as f1:
+                    return f1.read()
+            write_new_file(pdf_fn, read_pdf)
 
         print(num_new_reports, "new reports from UNT,", num_new_versions, "new versions of existing reports")
 
 
-def load_crsreports_dot_congress_dot_gov_reports(reports):
+# Report version metadata files from crsreports.congress.gov are named
+# like R12345_1_2020-01-01.json (report number, sequence number, date).
+_RE_CONGRESS_GOV_FN = re.compile(r"([^/]+)_(\d+)_[\d-]+\.json$")
+
+def load_crsreports_dot_congress_dot_gov_reports(reports, seen_dates):
     # Load all of the CRS report version metadata that was scraped from
     # crsreports.congress.gov, the public website. Add each report version into the reports
     # dictionary that is keyed by the report ID (not the report version ID).
@@ -369,31 +425,31 @@ def load_crsreports_dot_congress_dot_gov_reports(reports):
 
     # Scan the "incoming" directory for report version metadata...
     source_dir = "crsreports.congress.gov"
-    for fn in sorted(glob.glob(os.path.join(INCOMING_DIR, source_dir + "/documents/*.json"))):
-        with open(fn) as f:
-            try:
-                doc = json.load(f)
-            except ValueError as e:
-                print(fn, e)
-                continue
+    for fn in list_json_files(os.path.join(INCOMING_DIR, source_dir, "documents")):
+        doc = load_json_file(fn)
+        if doc is None:
+            continue
 
-        m = re.search(r"/([^/]+)_(\d+)_[\d-]+\.json$", fn)
+        m = _RE_CONGRESS_GOV_FN.match(os.path.basename(fn))
+        if not m:
+            print(fn, "doesn't look like a report version file name")
+            continue
         reportId = m.group(1)
 
         # Check that we don't have this version already --- we may have it from
         # a different data source.
-        for v in reports[reportId]:
-            if v["date"] == doc["date"]:
-                # There's already a document for this date.
-                break
-        else:
-            # This record is new.
-            # Store by report number.
-            doc["source_dir"] = source_dir
-            reports[reportId].append(doc)
+        if doc["date"][:10] in seen_dates[reportId]:
+            # There's already a document for this date.
+            continue
+
+        # This record is new.
+        # Store by report number.
+        doc["source_dir"] = source_dir
+        seen_dates[reportId].add(doc["date"][:10])
+        reports[reportId].append(doc)
 
 
-def load_fas_reports(reports):
+def load_fas_reports(reports, seen_dates):
     # Load the reports from the https://sgp.fas.org/crs/ archive.
     # Although the 5 GB archive has 8900 reports (exactly), there
     # are actually only 261 document files (161 reports) that we
@@ -435,9 +491,6 @@ def load_fas_reports(reports):
         "www.fas.org/irp/crs/RS21743.html": "RS21743",
     }
 
-    import zipfile
-    import re
-    import os.path
     import dateutil.parser
 
     archive_html_encoding = "latin1"
@@ -473,7 +526,6 @@ def load_fas_reports(reports):
                         report_number = other_report_numbers[pdf_fn_abs]
                     else:
                         # Construct arbitrary report numbers that are stable and hopefully won't collide.
-                        import hashlib
                         report_number = "ZZZ" + hashlib.sha256(pdf_fn.encode('ascii')).hexdigest().upper()[0:16]
 
                     # See if this PDF exists in the ZIP arhive.
@@ -540,85 +592,113 @@ def load_fas_reports(reports):
                     report_version_id = report_number + "_FAS"
 
                     # Create the metadata record for this report version.
-                    rec = collections.OrderedDict([
-                        ("source", FAS_SOURCE_STRING),
-                        ("sourceLink", "https://sgp.fas.org/crs/"),
-                        ("id", report_version_id),
-                        ("date", report_date.isoformat()),
-                        ("retrieved", retrieved_date.isoformat()),
-                        ("title", report_title),
-                        ("summary", None),
-                        ("type", "CRS Report"), # are they all reports?
-                        ("typeId", "REPORT"),
-                        ("active", False),
-                        ("formats", [
-                            collections.OrderedDict([
-                                ("format", "PDF"),
-                                ("filename", pdf_fn),
-                            ])
-                            ]),
-                        ("topics", [ ]),
-                    ])
+                    rec = {
+                        "source": FAS_SOURCE_STRING,
+                        "sourceLink": "https://sgp.fas.org/crs/",
+                        "id": report_version_id,
+                        "date": report_date.isoformat(),
+                        "retrieved": retrieved_date.isoformat(),
+                        "title": report_title,
+                        "summary": None,
+                        "type": "CRS Report", # are they all reports?
+                        "typeId": "REPORT",
+                        "active": False,
+                        "formats": [
+                            {
+                                "format": "PDF",
+                                "filename": pdf_fn,
+                            }
+                            ],
+                        "topics": [ ],
+                    }
 
                     # Don't add this report if we already have this report version
                     # by checking the report date.
                     if report_number not in reports:
                         num_new_reports += 1
-                    is_dup = False
-                    for v in reports[report_number]:
-                        if v["date"][:10] == rec["date"][:10]:
-                            # There's already a document for this date.
-                            # We seem to have duplicates within the UNT archive
-                            # and of course also across collections.
-                            is_dup = True
-                            break
-                    if is_dup:
+                    if rec["date"][:10] in seen_dates[report_number]:
+                        # There's already a document for this date.
+                        # We seem to have duplicates within the UNT archive
+                        # and of course also across collections.
                         continue
 
                     # This report version is new, and also track if this report is new.
                     num_new_report_versions += 1
                     
+                    seen_dates[report_number].add(rec["date"][:10])
                     reports[report_number].append(rec)
 
                     # Save PDF file. We may or may not have read it earlier.
                     pdf_fn = os.path.join(REPORTS_DIR, pdf_fn)
-                    if not os.path.exists(pdf_fn):
-                        if pdf_content is None:
-                            with archive.open(pdf_fn_abs) as f1:
-                                pdf_content = f1.read()
-                        with open(pdf_fn, "wb") as f:
-                            f.write(pdf_content)
+                    def read_pdf():
+                        if pdf_content is not None:
+                            return pdf_content
+                        with archive.open(pdf_fn_abs) as f1:
+                            return f1.read()
+                    write_new_file(pdf_fn, read_pdf)
 
     print("{} new reports and {} new report versions from FAS.".format(num_new_reports, num_new_report_versions))
 
-def add_missing_html_formats(reports, all_files):
-    for report, version, file in tqdm.tqdm(list(iter_files()), desc="extracting HTML"):
+def add_missing_html_formats(files, all_files):
+    file_exists = make_file_exists_checker()
+
+    # Find report versions with a PDF but no HTML. Remember the versions we
+    # already have HTML for from the last run of this script and the ones we
+    # need to convert.
+    html_versions = []
+    conversions = []
+    seen_versions = set()
+    for report, version, file in tqdm.tqdm(files, desc="finding PDFs without HTML"):
             # What formats are available for this version?
             formats = { format["format"]: format["filename"] for format in version["formats"] }
             if "HTML" in formats: continue
-            if file["format"] == "PDF" and os.path.exists(os.path.join(REPORTS_DIR, formats["PDF"])):
+            if id(version) in seen_versions: continue
+            if file["format"] == "PDF" and file_exists(os.path.join(REPORTS_DIR, formats["PDF"])):
+                pdf_fn = os.path.join(REPORTS_DIR, formats["PDF"])
+                seen_versions.add(id(version))
                 html_fn = file["filename"].replace(".pdf", ".html")
 
                 all_files.add(html_fn)
 
-                # Convert, unless we have it already from the last run of this script.
-                if not os.path.exists(os.path.join(REPORTS_DIR, html_fn)) and os.path.exists(os.path.join(REPORTS_DIR, formats["PDF"])):
-                    try:
-                        html_fmt = pdf_to_html_using_pymupdf(os.path.join(REPORTS_DIR, formats["PDF"]))
-                        if html_fmt == "": continue
-                    except:
-                        continue # skip data errors
-
-                    # Save the HTML.
-                    with open(os.path.join(REPORTS_DIR, html_fn), "w") as f:
-                        f.write(html_fmt)
-
-                # Add to metadata.
-                version["formats"].append(collections.OrderedDict([
-                    ("format", "HTML"),
-                    ("filename", html_fn),
-                    ("source", "pymupdf"),
-                ]))
+                if file_exists(os.path.join(REPORTS_DIR, html_fn)):
+                    html_versions.append((version, html_fn))
+                else:
+                    conversions.append((version, pdf_fn, html_fn))
+
+    # Convert the PDFs in parallel since it's CPU-bound. Data errors are
+    # skipped. Usually there's nothing new to convert, so don't start a pool
+    # then.
+    if conversions:
+        with Pool() as pool:
+            results = pool.imap(convert_pdf_to_html,
+                                [(pdf_fn, os.path.join(REPORTS_DIR, html_fn)) for version, pdf_fn, html_fn in conversions],
+                                chunksize=8)
+            for (version, pdf_fn, html_fn), ok in tqdm.tqdm(zip(conversions, results), total=len(conversions), desc="extracting HTML"):
+                if ok:
+                    html_versions.append((version, html_fn))
+
+    # Add to metadata.
+    for version, html_fn in html_versions:
+        version["formats"].append({
+            "format": "HTML",
+            "filename": html_fn,
+            "source": "pymupdf",
+        })
+
+def convert_pdf_to_html(fns):
+    # Convert a PDF to HTML and save it, in a pool worker. Returns whether
+    # an HTML file was written.
+    pdf_fn, html_fn = fns
+    try:
+        html_fmt = pdf_to_html_using_pymupdf(pdf_fn)
+    except Exception:
+        return False # skip data errors
+    if html_fmt == "": return False
+
+    # Save the HTML.
+    with open(html_fn, "w") as f:
+        f.write(html_fmt)
+    return True
 
 def pdf_to_html_using_pdftotext(fn):
     # Use pdftotext to convert to plain text and then wrap in a preformatted div.
@@ -665,7 +745,6 @@ def pdf_to_html_using_pdftohtml(fn):
          os.unlink(img_fn) # remove the extracted image file
 
          # Skip known images --- identify by the hash.
-         import hashlib
          h = hashlib.sha1()
          h.update(im_bytes)
          if h.hexdigest() in ("e33a534ead5596fcdaf2f395005c893e699393d8", "cf0a915631567be404e4ace0eeaaeae95f84ed62", "d437e97be11016d9c0c419a2ddc53a63423b1216"):
@@ -694,8 +773,8 @@ def pdf_to_html_using_pymupdf(fn):
 def transform_report_metadata(report_number, report_versions):
     # Construct the data structure for a report, given a list of report versions.
     #
-    # The return value is an OrderedDict so that our output maintains the fields
-    # in a consistent order.
+    # Dicts preserve insertion order so our output maintains the fields in a
+    # consistent order.
 
     # construct a source string that lists sources in reverse chronological order
     sources = []
@@ -704,20 +783,20 @@ def transform_report_metadata(report_number, report_versions):
             sources.append(m["source"])
 
     m = report_versions[0]
-    return collections.OrderedDict([
-        ("id", report_number),
-        ("type", m['type']),
-        ("typeId", m['typeId']),
-        ("number", report_number),
-        ("active", m["active"]),
-        ("source", ", ".join(sources)),
-        ("versions", report_versions),
-    ])
+    return {
+        "id": report_number,
+        "type": m['type'],
+        "typeId": m['typeId'],
+        "number": report_number,
+        "active": m["active"],
+        "source": ", ".join(sources),
+        "versions": report_versions,
+    }
 
 
 # Iterate through all of the HTML and PDF files, yielding
 # each file that needs processing.
-def iter_files():
+def iter_files(reports):
     for report in reports:
         for version in reversed(report["versions"]):
             for file in version["formats"]:
@@ -728,19 +807,44 @@ def iter_files():
                 )
 
 
-def clean_files(reports, all_files):
-    # Use a multiprocessing pool to divide the load across processors.
-    from multiprocessing import Pool
-    pool = Pool()
+def make_file_exists_checker():
+    # Return a function that checks if a file exists by listing its directory
+    # the first time the directory is seen and then looking the file up in
+    # the listing, which saves a stat() call per file when checking many files
+    # in the same few directories. Listings aren't refreshed, so files created
+    # after the first check in their directory aren't seen.
+    listings = { }
+    def file_exists(path):
+        dirname, basename = os.path.split(path)
+        if dirname not in listings:
+            try:
+                listings[dirname] = set(os.listdir(dirname))
+            except FileNotFoundError:
+                listings[dirname] = set()
+        return basename in listings[dirname]
+    return file_exists
+
+
+def clean_files(files, all_files):
+    # Use a multiprocessing pool to divide the load across processors. Replace
+    # each worker process after a number of tasks so that memory held onto by
+    # lxml and the PDF redactor doesn't build up over a long run.
+    pool = Pool(maxtasksperchild=50)
+
+    # Check which input and output files exist by listing each directory once
+    # rather than calling stat() for each file.
+    file_exists = make_file_exists_checker()
 
-    open_tasks = []
+    tasks = []
 
-    for report, version, file in tqdm.tqdm(list(iter_files()), desc="cleaning HTML/PDFs"):
+    for report, version, file in tqdm.tqdm(files, desc="scanning HTML/PDFs"):
         fn = file["filename"]
         if "ONLY" in os.environ and os.environ["ONLY"] not in fn: continue
 
         # Remmeber that this was a file and also remember any related files we generate from it.
         all_files.add(fn)
+        if fn.endswith(".html"):
+            all_files.add(get_text_fn(fn))
         
         # Process the file.
         in_fn = os.path.join(INCOMING_DIR, version.get("source_dir", ""), fn)
@@ -751,32 +855,33 @@ def clean_files(reports, all_files):
         # own SHA1 hash in their file name, we know once we processed it that it's
         # done. If we change the logic in this module then you should delete the
         # whole reports/files directory and re-run this.
-        if os.path.exists(in_fn) and not os.path.exists(out_fn):
+        if file_exists(in_fn) and not file_exists(out_fn):
             if fn.endswith(".html"):
-                ar = pool.apply_async(trap_all, [clean_html, in_fn, out_fn, version, file])
+                tasks.append((clean_html, in_fn, out_fn, version, file))
             elif fn.endswith(".pdf"):
-                ar = pool.apply_async(trap_all, [clean_pdf, in_fn, out_fn, version])
-            else:
-                continue
-            open_tasks.append(ar)
+                tasks.append((clean_pdf, in_fn, out_fn, version))
 
         # Link scraped images into the output folder.
         if fn.endswith(".html") and file.get("images"):
             for img in file["images"].values():
                 img_fn = os.path.join(INCOMING_DIR, version.get("source_dir", ""), img)
-                if not os.path.exists(img_fn): continue # ignore missing images
+                if not file_exists(img_fn): continue # ignore missing images
                 make_link(img_fn, os.path.join(REPORTS_DIR, img))
                 all_files.add(img)
 
-        # So that the tqdm progress meter works, wait synchronously
-        # every so often.
-        if len(open_tasks) > 20:
-            open_tasks.pop(0).wait()
+    # Run the tasks. imap_unordered hands out tasks as workers become free and
+    # yields as each one finishes, so a slow file doesn't hold up the others
+    # and the progress meter advances on completion.
+    for _ in tqdm.tqdm(pool.imap_unordered(run_task, tasks, chunksize=4), total=len(tasks), desc="cleaning HTML/PDFs"):
+        pass
 
     # Generate a thumbnail for the most recent version of a report. Don't delete thumbnails for
-    # previous versions so always add the png filename to all_files.
+    # previous versions so always add the png filename to all_files. This runs after all of the
+    # PDFs have been cleaned above since thumbnails are made from the cleaned PDFs.
+    file_exists = make_file_exists_checker()
+    tasks = []
     is_most_recent_version = { }
-    for report, version, file in tqdm.tqdm(list(iter_files()), desc="generating thumbnails"):
+    for report, version, file in files:
         fn = file["filename"]
         if not fn.endswith(".pdf"): continue
         if "ONLY" in os.environ and os.environ["ONLY"] not in fn: continue
@@ -795,21 +900,98 @@ def clean_files(reports, all_files):
 
         # Since the files have their own SHA1 hash in their file name, we know once we
         # processed it that it's done.
-        if os.path.exists(png_fn): continue
+        if file_exists(png_fn): continue
 
-        ar = pool.apply_async(trap_all, [make_pdf_thumbnail, pdf_fn])
-        open_tasks.append(ar)
+        tasks.append((make_pdf_thumbnail, pdf_fn))
 
-        # So that the tqdm progress meter works, wait synchronously
-        # every so often.
-        if len(open_tasks) > 5:
-            open_tasks.pop(0).wait()
+    for _ in tqdm.tqdm(pool.imap_unordered(run_task, tasks, chunksize=4), total=len(tasks), desc="generating thumbnails"):
+        pass
 
-    # Wait for the last processes to be done.
+    # Shut down the worker processes.
     pool.close()
     pool.join()
 
 
+# lxml's HTML parser is written in C and is much faster than html5lib,
+# which is pure Python. The parser is reusable across documents.
+_HTML_PARSER = lxml.html.HTMLParser()
+
+# The namespace html5lib puts elements in, as it appears in lxml tag names.
+_XHTML_NS = "{http://www.w3.org/1999/xhtml}"
+_XHTML_NS_LEN = len(_XHTML_NS)
+
+def parse_html(content_bytes):
+    # Parse an HTML page into an lxml ElementTree whose elements are not
+    # namespaced.
+    try:
+        return lxml.html.document_fromstring(content_bytes, parser=_HTML_PARSER).getroottree()
+    except (lxml.etree.ParserError, lxml.etree.XMLSyntaxError):
+        pass
+
+    # If lxml couldn't parse the page, fall back to html5lib. html5lib gives
+    # some warnings about malformed content that we don't care about -- hide
+    # warnings.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        dom = html5lib.parse(content_bytes, treebuilder="lxml")
+
+    # Remove the XHTML namespace that html5lib adds to make processing easier.
+    for tag in dom.iter():
+        if isinstance(tag.tag, str) and tag.tag.startswith(_XHTML_NS): # is an element
+            tag.tag = tag.tag[_XHTML_NS_LEN:]
+    lxml.etree.cleanup_namespaces(dom)
+
+    return dom
+
+_NO_CSS_CLASSES = frozenset()
+
+def get_css_classes(node):
+    # Get the set of CSS classes on an element. Most elements don't have a
+    # class attribute, so don't build a new set for those.
+    cls = node.attrib.get('class')
+    if not cls:
+        return _NO_CSS_CLASSES
+    return frozenset(cls.split(" "))
+
+# The element holding the report content in pages scraped from crs.gov, or,
+# for Insights, the element that holds their content. These return at most
+# one element, the first in document order.
+_XPATH_REPORT = lxml.etree.XPath("(//*[@class='Report'])[1]")
+_XPATH_INSIGHT_CONTENT = lxml.etree.XPath("(//*[@id='Insightsdiv']/*[@class='ReportContent'])[1]")
+
+# mailto: links, in any letter case. These select from the context node
+# itself as well as its descendants and are evaluated by libxml2 in C.
+_XPATH_MAILTO_LINKS = lxml.etree.XPath(
+    "descendant-or-self::*[starts-with(translate(@href, 'MAILTO', 'mailto'), 'mailto:')]")
+
+# h1-h5 headings, except ones that are (or will become) the report title.
+_XPATH_DEMOTED_HEADINGS = lxml.etree.XPath(
+    "descendant-or-self::*[self::h1 or self::h2 or self::h3 or self::h4 or self::h5]"
+    "[not(contains(concat(' ', @class, ' '), ' Title ')"
+    " or contains(concat(' ', @class, ' '), ' titleline '))]")
+
+# The CSS classes that are kept in published report HTML.
+ALLOWED_CLASSES = frozenset({ 'ReportHeader' })
+
+# What h#s are demoted to.
+DEMOTED_HEADINGS = { "h1": "h2", "h2": "h3", "h3": "h4", "h4": "h5", "h5": "h6" }
+
+# Classes that are turned into h#s.
+HEADING_CLASSES = {
+    "Heading1": "h2",
+    "Heading2": "h3",
+    "Heading3": "h4",
+    "Heading4": "h5",
+    "Heading5": "h6",
+    "SummaryHeading": "h2",
+}
+
+# The tag name that clean_html gives to elements it will remove.
+_REMOVED_TAG = "_removed"
+
+# Links to reports on crs.gov, which are rewritten to link to our site.
+_RE_CRS_REPORT_LINK = re.compile("^http://www\\.crs\\.gov/Reports/([0-9A-Z-]+)$")
+
 def clean_html(content_fn, out_fn, report_metadata, file_metadata):
     # Transform the scraped HTML page to the one that we publish:
     #
@@ -826,72 +1008,68 @@ def clean_html(content_fn, out_fn, report_metadata, file_metadata):
     with open(content_fn, "rb") as f:
         content_bytes = f.read()
 
-    # Parse the page as HTML5. html5lib gives some warnings about malformed
-    # content that we don't care about -- hide warnings.
-    import warnings
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        content = html5lib.parse(content_bytes, treebuilder="lxml")
-    
+    # Parse the page.
+    content = parse_html(content_bytes)
+
     if report_metadata["source"] == "CRSReports.Congress.gov":
         # Get the body node. Change it to a div.
-        content = content.getroot().find("{http://www.w3.org/1999/xhtml}body")
+        content = content.getroot().find("body")
         content.tag = "div"
     else:
         # For HTML scraped from crs.gov...
 
         # Extract the report itself from the whole page.
-        n = content.find(".//*[@class='Report']")
-        if n is None:
-            n = content.find(".//*[@id='Insightsdiv']/*[@class='ReportContent']")
-        if n is None:
+        n = _XPATH_REPORT(content) or _XPATH_INSIGHT_CONTENT(content)
+        if not n:
             raise ValueError("HTML page doesn't contain an element that we know to pull body content from")
-        content = n
+        content = n[0]
 
         # Some reports are invalid HTML with a whole doctype and html node inside
         # the main report container element. See if this is one of those documents.
         if b'<div class="Report"><!DOCTYPE' in content_bytes:
-            content = content.find("{http://www.w3.org/1999/xhtml}blockquote")
+            content = content.find("blockquote")
             if content is None:
                 raise ValueError("HTML page didn't have the expected blockquote.")
             content.tag = "div"
 
-    # Remove the XHTML namespace to make processing easier.
-    for tag in [content] + content.findall(".//*"):
-        if isinstance(tag.tag, str): # is an element
-            tag.tag = tag.tag.replace("{http://www.w3.org/1999/xhtml}", "")
-
     # Scrub content and adjust some tags.
 
-    allowed_classes = { 'ReportHeader' }
-
-    def scrub_text(text):
-        # Scrub crs.gov email addresses from the text.
-        # There's a separate filter later for addresses in mailto: links.
-        text = re.sub(r"[a-zA-Z0-9_!#\$%&\'\*\+\-/=\?\^`\{\|\}~]+@crs\.(loc\.)?gov", "[email address scrubbed]", text)
-
-        # Scrub CRS telephone numbers --- in 7-xxxx format. We have to exclude
-        # cases that have a preceding digit, because otherwise we match
-        # strings like "2007-2009". But the number can also occur at the start
-        # of a node, so it may be the start of a string.
-        text = re.sub(r"(^|[^\d])7-\d\d\d\d", r"\1[phone number scrubbed]", text)
-
-        # Scrub all telephone numbers --- in (xxx) xxx-xxxx format.
-        text = re.sub(r"\(\d\d\d\) \d\d\d-\d\d\d\d", "[phone number scrubbed]", text)
-
-        return text
-
     whitelisted_image_paths = set()
 
-    for tag in [content] + content.findall(".//*"):
-        # Skip non-element nodes.
-        if not isinstance(tag.tag, str): continue
-
-        # Scrub the text.
+    # Elements to remove. lxml's iterator doesn't allow the tree to be
+    # restructured while iterating over it, so they're removed after the loop
+    # below.
+    removed_nodes = []
+
+    # Scrub mailto: links, which have author emails, which we want to scrub,
+    # as well as email addresses of other people mentioned in the reports.
+    for tag in _XPATH_MAILTO_LINKS(content):
+        tag.tag = "span"
+        del tag.attrib['href']
+        tag.text = "[email address scrubbed]"
+        del tag[:] # remove all child nodes
+
+    # Demote h#s. These seem to occur around the table of contents only. Don't
+    # demote the title, which becomes an h1 in the loop below.
+    for tag in _XPATH_DEMOTED_HEADINGS(content):
+        tag.tag = DEMOTED_HEADINGS[tag.tag]
+
+    # Walk the tree once. iter() includes content itself. The tag name and
+    # attributes are held in locals since they're checked many times.
+    for tag in content.iter():
+        name = tag.tag
+
+        # Scrub the text. Comments and other non-element nodes are skipped
+        # below, but their tail text is still part of the page.
+        if not isinstance(name, str):
+            if tag.tail is not None: tag.tail = scrub_text(tag.tail)
+            continue
         if tag.text is not None: tag.text = scrub_text(tag.text)
         if tag.tail is not None: tag.tail = scrub_text(tag.tail)
 
-        css_classes = set(tag.attrib.get('class', '').split(" "))
+        attrib = tag.attrib
+
+        css_classes = get_css_classes(tag)
 
         # Modern reports have a ReportHeader node with title, authors, date, report number,
         # and an internal link to just past the table of contents. Since we are scrubbing
@@ -899,108 +1077,172 @@ def clean_html(content_fn, out_fn, report_metadata, file_metadata):
         # link and replace the title with an <h1> tag.
         if "ReportHeader" in css_classes:
             for node in tag:
-                node_css_classes = set(node.attrib.get('class', '').split(" "))
+                node_css_classes = get_css_classes(node)
                 if "Title" in node_css_classes:
                     node.tag = "h1"
                 elif "CoverDate" in node_css_classes:
                     pass # keep this one
                 else:
-                    node.getparent().remove(node)
+                    removed_nodes.append(node)
 
         # Older reports had a "titleline" class for the title.
         if "titleline" in css_classes:
-            tag.tag = "h1"
-            css_classes.add("Title") # so the h1 doesn't get demoted below
+            tag.tag = name = "h1"
+            css_classes |= { "Title" } # so the h1 doesn't get demoted below
 
         # Older reports had an "authorline" with author names, which we scrub by
         # removing completely.
         if "authorline" in css_classes:
-            tag.getparent().remove(tag)
+            removed_nodes.append(tag)
 
         # Older reports had a "Print Version" link, which we can remove.
-        if tag.tag == "a" and tag.text == "Print Version":
-            tag.getparent().remove(tag)
-
-        # Scrub mailto: links, which have author emails, which we want to scrub,
-        # as well as email addresses of other people mentioned in the reports.
-        if 'href' in tag.attrib and tag.attrib['href'].lower().startswith("mailto:"):
-            tag.tag = "span"
-            del tag.attrib['href']
-            tag.text = "[email address scrubbed]"
-            for n in tag: # remove all child nodes
-                tag.remove(n)
+        if name == "a" and tag.text == "Print Version":
+            removed_nodes.append(tag)
 
         # Replace img files with scraped files.
-        if tag.tag == "img" and tag.attrib["src"] in (file_metadata.get("images") or {}):
+        if name == "img" and attrib["src"] in (file_metadata.get("images") or {}):
             # Get the path to the scraped file.
             # Make the path absolute because the relative location will be different
             # for the raw HTML (in the files directory just like the image) and
             # the published report path (in /reports).
-            path = "/" + file_metadata["images"][tag.attrib["src"]]
-            tag.attrib["src"] = path
-            whitelisted_image_paths.add(tag.attrib["src"])
+            path = "/" + file_metadata["images"][attrib["src"]]
+            attrib["src"] = path
+            whitelisted_image_paths.add(path)
 
         # Rewrite internal crs.gov links to point to the corresponding report on
         # everycrsreport.com.
-        if tag.tag == "a" and "href" in tag.attrib:
-            if tag.attrib["href"].startswith("http://www.crs.gov/Reports/"):
-                tag.attrib["href"] = re.sub("^http://www\\.crs\\.gov/Reports/([0-9A-Z-]+)$",
+        if name == "a" and "href" in attrib:
+            if attrib["href"].startswith("http://www.crs.gov/Reports/"):
+                attrib["href"] = _RE_CRS_REPORT_LINK.sub(
                                             "https://www.everycrsreport.com/reports/\\1.html",
-                                            tag.attrib["href"])
-
-        # Demote h#s. These seem to occur around the table of contents only. Don't
-        # demote the one we just made above for the title.
-        if tag.tag in ("h1", "h2", "h3", "h4", "h5") and "Title" not in css_classes:
-            tag.tag = "h" + str(int(tag.tag[1:])+1)
-
-        # Turn some classes into h#s.
-        for cls in css_classes:
-            if cls in ("Heading1", "Heading2", "Heading3", "Heading4", "Heading5"):
-                tag.tag = "h" + str(int(cls[7:])+1)
-            if cls == "SummaryHeading":
-                tag.tag = "h2"
-
-        # Sanitize CSS classes using the whitelist above.
-        if "class" in tag.attrib:
-            new_classes = " ".join(sorted(set(tag.attrib["class"].split(" ")) & allowed_classes))
-            if new_classes:
-                tag.attrib["class"] = new_classes
+                                            attrib["href"])
+
+        # Turn some classes into h#s, and sanitize CSS classes using the
+        # ALLOWED_CLASSES whitelist, in one pass over the set of classes we
+        # already split out of the attribute.
+        if "class" in attrib:
+            kept_classes = []
+            for cls in css_classes:
+                if cls in ALLOWED_CLASSES:
+                    kept_classes.append(cls)
+                new_tag = HEADING_CLASSES.get(cls)
+                if new_tag:
+                    tag.tag = new_tag
+            if kept_classes:
+                attrib["class"] = " ".join(sorted(kept_classes))
             else:
-                del tag.attrib["class"]
+                del attrib["class"]
+
+    # Remove the elements all at once: mark them with a tag name that can't
+    # occur in HTML and then have lxml strip every marked element, with its
+    # tail text, in a single pass. Comments can't be renamed, so remove
+    # those individually.
+    for node in removed_nodes:
+        if isinstance(node.tag, str):
+            node.tag = _REMOVED_TAG
+        else:
+            parent = node.getparent()
+            if parent is not None:
+                parent.remove(node)
+    lxml.etree.strip_elements(content, _REMOVED_TAG, with_tail=True)
+
+    # Get the report's plain text for the search index, so that the indexer
+    # doesn't have to parse the HTML again. Drop script and style elements
+    # first, whose content the sanitizer would drop too. The text nodes were
+    # already scrubbed above.
+    lxml.etree.strip_elements(content, "script", "style", with_tail=False)
+    text = lxml.etree.tostring(content, encoding=str, method="text")
 
     # Serialize back to XHTML.
     content = lxml.etree.tostring(content, encoding=str, method="html")
 
     # Guard against unsafe content.
-    import bleach
-    def link_filter(tag, name, value):
-        if name in ("name", "class"):
-            return True # "name" is for link targets
-        if name == "href" and (value.startswith("http:") or value.startswith("https:") or value.startswith("#")):
-            return True
-        return False
-    def image_filter(tag, name, value):
-        if name in ("class",):
-            return True
-        if name == "src" and (value.startswith("http:") or value.startswith("https:") or value in whitelisted_image_paths):
-            return True
-        return False
-    content = bleach.clean(
-        content,
-        tags=["a", "img", "b", "strong", "i", "em", "u", "sup", "sub", "span", "div", "p", "br", "ul", "ol", "li", "table", "thead", "tbody", "tr", "th", "td", "hr", "h1", "h2", "h3", "h4", "h5", "h6"],
-        attributes={
-            "*": ["title", "class"],
-            "a": link_filter,
-            "img": image_filter,
-            "td": ["colspan", "rowspan"],
-            "th": ["colspan", "rowspan"],
-        }
-    )
+    content = sanitize_html(content, whitelisted_image_paths)
 
-    # Write it out.
+    # Write it out. Write the text first so that if the HTML file exists,
+    # which is how clean_files knows this file is done, so does the text.
+    with open(get_text_fn(out_fn), "w") as f2:
+        f2.write(text)
     with open(out_fn, "w") as f2:
         f2.write(content)
 
+def get_text_fn(html_fn):
+    # Get the path to the plain text file that clean_html writes alongside
+    # a cleaned HTML file.
+    return os.path.splitext(html_fn)[0] + ".txt"
+
+# A single regular expression for everything that scrub_text scrubs, so
+# that each string is scanned once rather than once per kind of match:
+#
+# * crs.gov email addresses. There's a separate filter later for addresses
+#   in mailto: links.
+# * CRS telephone numbers --- in 7-xxxx format. We have to exclude cases
+#   that have a preceding digit, because otherwise we match strings like
+#   "2007-2009". But the number can also occur at the start of a node, so
+#   it may be the start of a string.
+# * All telephone numbers --- in (xxx) xxx-xxxx format.
+#
+# Where matches overlap, the result is the same as scrubbing email addresses
+# first and then each kind of phone number. The email alternative comes
+# first, so it wins over a CRS phone number starting at the same place. The
+# lookbehind doesn't consume the character before a CRS phone number, so
+# that character can still start an email address. The lookahead leaves a
+# full phone number that is the start of an email address to the email
+# alternative.
+_RE_SCRUB_EMAIL_LOCAL_PART = r"[a-zA-Z0-9_!#\$%&\'\*\+\-/=\?\^`\{\|\}~]"
+_RE_SCRUB = re.compile(
+    r"(?P<crsemail>" + _RE_SCRUB_EMAIL_LOCAL_PART + r"+@crs\.(?:loc\.)?gov)"
+    r"|(?<!\d)(?P<crsphone>7-\d\d\d\d)"
+    r"|(?P<phone>\(\d\d\d\) \d\d\d-\d\d\d\d)(?!" + _RE_SCRUB_EMAIL_LOCAL_PART + r"*@crs\.(?:loc\.)?gov)")
+
+def _scrub_replacement(m):
+    if m.group("crsemail"):
+        return "[email address scrubbed]"
+    return "[phone number scrubbed]"
+
+# Everything _RE_SCRUB matches contains an @-sign or a digit. Most text
+# has neither, and this is much cheaper to check for.
+_RE_SCRUB_HINT = re.compile(r"[@\d]")
+
+def scrub_text(text):
+    if not _RE_SCRUB_HINT.search(text):
+        return text
+    return _RE_SCRUB.sub(_scrub_replacement, text)
+
+def run_task(task):
+    # Run a (function, arg1, ...) tuple queued by clean_files in a pool worker.
+    trap_all(*task)
+
+# The tags and attributes that may appear in published report HTML.
+SANITIZE_TAGS = {"a", "img", "b", "strong", "i", "em", "u", "sup", "sub", "span", "div", "p", "br", "ul", "ol", "li", "table", "thead", "tbody", "tr", "th", "td", "hr", "h1", "h2", "h3", "h4", "h5", "h6"}
+SANITIZE_ATTRIBUTES = {
+    "*": {"title", "class"},
+    "a": {"href", "name"}, # "name" is for link targets
+    "img": {"src"},
+    "td": {"colspan", "rowspan"},
+    "th": {"colspan", "rowspan"},
+}
+
+def sanitize_html(content, image_paths):
+    # Guard against unsafe content using nh3, which does the work in native
+    # code. Links may only go to http(s) URLs or to targets within the page,
+    # and images may only come from http(s) URLs or from the scraped image
+    # paths in image_paths.
+    def attribute_filter(tag, name, value):
+        if tag == "a" and name == "href" and not value.startswith(("http:", "https:", "#")):
+            return None
+        if tag == "img" and name == "src" and not (value.startswith(("http:", "https:")) or value in image_paths):
+            return None
+        return value
+    return nh3.clean(
+        content,
+        tags=SANITIZE_TAGS,
+        attributes=SANITIZE_ATTRIBUTES,
+        attribute_filter=attribute_filter,
+        url_schemes={"http", "https"},
+        link_rel=None,
+    )
+
 def trap_all(func, in_file, *args):
     try:
         func(in_file, *args)
@@ -1026,15 +1268,37 @@ def clean_pdf(in_file, out_file, file_metadata):
 def make_pdf_thumbnail(pdf_file):
     # Generate a thumbnail image of the PDF.
     # Note that pdftoppm adds ".png" to the end of the file name.
-    import subprocess
     subprocess.check_call(['pdftoppm', '-png', '-singlefile',
                            '-scale-to-x', '600', '-scale-to-y', '-1',
                            pdf_file, pdf_file.replace(".pdf", "")])
 
 
+# A single content filter for redacting phone numbers and email addresses in
+# PDFs, so that the redactor scans each PDF's text once rather than once per
+# kind of match. See the notes on the regular expressions above for the HTML
+# scrubber. Phone numbers are replaced with symbols likely to be available.
+#
+# Where matches overlap, the result is the same as redacting CRS phone
+# numbers, then full phone numbers, then email addresses, in turn. Phone
+# numbers take priority, so an email address's local part can't run across
+# the start of a CRS phone number. The lookbehinds leave the character before
+# a CRS phone number unconsumed, so it can still end an email address.
+_RE_PDF_REDACT = re.compile(
+    r"(?<!\d)(?P<crsphone>7-)\d{4}"
+    r"|(?P<phone>\(\d\d\d\) \d\d\d-\d\d\d\d)"
+    r"|(?:(?!(?<!\d)7-\d{4})[a-zA-Z0-9_!#\$%&\'\*\+\-/=\?\^`\{\|\}~])+(?P<crsemail>@crs.?(loc|gov))")
+
+def _pdf_redact_replacement(m):
+    if m.group("crsphone"):
+        return "7-...."
+    if m.group("phone"):
+        return "[redacted]"
+    return "[redacted]" + m.group("crsemail")
+
+_PDF_CONTENT_FILTERS = [(_RE_PDF_REDACT, _pdf_redact_replacement)]
+
 def redact_pdf(in_file, out_file, file_metadata):
     from pdf_redactor import redactor, RedactorOptions
-    import io, re, subprocess, tempfile, shutil
 
     # Set redaction options.
 
@@ -1059,12 +1323,7 @@ def redact_pdf(in_file, out_file, file_metadata):
     redactor_options.xmp_filters = [lambda xml : None]
 
     # Redact phone numbers and email addresses.
-    # See the notes on the regular expressions above for the HTML scrubber.
-    redactor_options.content_filters = [
-        (re.compile(r"((^|[^\d])7-)\d{4}"), lambda m : m.group(1) + "...."), # use a symbol likely to be available
-        (re.compile(r"\(\d\d\d\) \d\d\d-\d\d\d\d"), lambda m : "[redacted]"), # use a symbol likely to be available
-        (re.compile(r"[a-zA-Z0-9_!#\$%&\'\*\+\-/=\?\^`\{\|\}~]+(@crs.?(loc|gov))"), lambda m : ("[redacted]" + m.group(1))),
-    ]
+    redactor_options.content_filters = _PDF_CONTENT_FILTERS
 
     # Avoid inserting ?'s and spaces.
     redactor_options.content_replacement_glyphs = ['#', '*', '/', '-']
@@ -1085,35 +1344,36 @@ def redact_pdf(in_file, out_file, file_metadata):
             raise
 
     with tempfile.NamedTemporaryFile() as f1:
-        with tempfile.NamedTemporaryFile() as f2:
-
-            # Run the redactor. Since qpdf in the next step requires an actual file for the input,
-            # write the output to a file.
-            redactor_options.input_stream = io.BytesIO(data)
-            redactor_options.output_stream = f1
-            try:
-                redactor(redactor_options)
-            except:
-                # The redactor has some trouble on old files. Post them anyway.
-                if file_metadata['date'] < "2003-01-01":
-                    print("Writing", out_file, "without redacting.")
-                    f1.seek(0)
-                    f1.write(data)
-                else:
-                    raise
-            f1.flush()
-
-            # Linearize and add our own page to the end of the PDF. The qpdf command
-            # for this is pretty weird. All we're doing is appending a page.
-            import subprocess
-            subprocess.check_call(['qpdf', '--optimize-images', '--linearize', f1.name,
-                "--pages", f1.name, "branding/pdf-addendum-page.pdf", "--",
-                f2.name])
-
-            # Copy the final PDF to the output location. We don't write directly to
-            # out_file in the previous qpdf step in case of errors. If there's an
-            # error during writing, let's not leave a broken file.
-            shutil.copyfile(f2.name, out_file)
+        # Run the redactor. Since qpdf in the next step requires an actual file for the input,
+        # write the output to a file.
+        redactor_options.input_stream = io.BytesIO(data)
+        redactor_options.output_stream = f1
+        try:
+            redactor(redactor_options)
+        except:
+            # The redactor has some trouble on old files. Post them anyway.
+            if file_metadata['date'] < "2003-01-01":
+                print("Writing", out_file, "without redacting.")
+                # Discard anything the redactor wrote before it failed.
+                f1.seek(0)
+                f1.truncate()
+                f1.write(data)
+            else:
+                raise
+        f1.flush()
+
+        # Linearize and add our own page to the end of the PDF. The qpdf command
+        # for this is pretty weird. All we're doing is appending a page.
+        #
+        # We don't write directly to out_file in case of errors. If there's an
+        # error during writing, let's not leave a broken file. qpdf writes to a
+        # temporary file next to out_file instead, which is moved into place
+        # only once it is complete. Since it's on the same filesystem, that's
+        # a rename rather than another copy of the whole PDF.
+        subprocess.check_call(['qpdf', '--optimize-images', '--linearize', f1.name,
+            "--pages", f1.name, "branding/pdf-addendum-page.pdf", "--",
+            out_file + ".tmp"])
+        os.replace(out_file + ".tmp", out_file)
 
 # MAIN
 
@@ -1127,21 +1387,28 @@ if __name__ == "__main__":
 
     all_files = set()
 
+    # Get the list of all of the HTML and PDF files once for the steps below.
+    files = list(iter_files(reports))
+
     # Clean/sanitize the HTML and PDF files and generate PNG thumbnails.
-    clean_files(reports, all_files)
+    clean_files(files, all_files)
 
     # For any report with a PDF but no HTML, convert the PDF to HTML via pdftohtml.
     # Do this after sanitization so that we don't leak redacted information.
-    add_missing_html_formats(reports, all_files)
+    add_missing_html_formats(files, all_files)
 
     # Write out JSON.
     write_reports_metadata(reports)
 
     # Delete orphaned files.
+    # os.scandir streams the directory listing rather than building a list of
+    # every path first. Skip dot-files, which glob's '*' never matched.
     if "ONLY" not in os.environ:
-        for fn in glob.glob(os.path.join(REPORTS_DIR, 'files', '*')):
-            if fn[len(REPORTS_DIR)+1:] not in all_files:
-                print("deleting extraneous file", fn)
-                #raise ValueError(fn)
-                os.unlink(fn)
+        with os.scandir(os.path.join(REPORTS_DIR, 'files')) as entries:
+            for entry in entries:
+                if entry.name.startswith("."): continue
+                if "files/" + entry.name not in all_files:
+                    print("deleting extraneous file", entry.path)
+                    #raise ValueError(entry.path)
+                    os.unlink(entry.path)
 
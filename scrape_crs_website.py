@@ -114,17 +114,26 @@ def fetch_report_version(doc, seq, cover_date):
     pdf_url = "https://crsreports.congress.gov/product/pdf/{}/{}/{}".format(
       doc["ProductTypeCode"], doc["ProductNumber"], str(seq))
     print(pdf_url)
-    pdf_content = scraper.get(pdf_url).content
+    resp = scraper.get(pdf_url, stream=True)
     did_fetch = True
-    
-    # Get the SHA1 hash of the content, construct a path to save the PDF to,
-    # and save it.
+
+    # Save the content to a temporary file, getting the SHA1 hash of the
+    # content as it is streamed in rather than holding the whole PDF in
+    # memory. Then construct a path to save the PDF to and move it there.
     h = hashlib.sha1()
-    h.update(pdf_content)
+    tmp_file = BASE_PATH + "/files/" + report_version_id + ".pdf.tmp"
+    try:
+      with open(tmp_file, "wb") as f:
+        for chunk in resp.iter_content(65536):
+          h.update(chunk)
+          f.write(chunk)
+    except:
+      # Don't leave a partial download behind.
+      os.unlink(tmp_file)
+      raise
     pdf_content_hash = h.hexdigest()
     pdf_file = "files/" + cover_date.isoformat() + "_" + doc["ProductNumber"] + "_" + pdf_content_hash + ".pdf"
-    with open(BASE_PATH + "/" + pdf_file, "wb") as f:
-      f.write(pdf_content)
+    os.replace(tmp_file, BASE_PATH + "/" + pdf_file)
 
   # Construct metadata record.
   rec = OrderedDict([
@@ -1,19 +1,19 @@
 #!/usr/bin/env python3
 
 import datetime
+import functools
 import glob
 import hashlib
-import json
+from multiprocessing import Pool
 import os.path
-import html5lib
 import lxml.etree
-import pytz
+import orjson
 import tqdm
 
-from utils import parse_dt
-
 REPORTS_DIR = "processed-reports"
 INDEX_CACHE_FN = "/mnt/volume_nyc1_02/algolia-index-cache.json"
+INDEX_CACHE_LOG_FN = INDEX_CACHE_FN + ".log"
+INDEX_BATCH_SIZE = 100
 
 
 def update_search_index():
@@ -35,9 +35,7 @@ def update_search_index():
     })
 
     # Remember docs we've already pushed to the index.
-    cache = { }
-    if os.path.exists(INDEX_CACHE_FN):
-        cache = json.load(open(INDEX_CACHE_FN))
+    cache = load_index_cache()
 
     # Scan for reports that need to be updated.
     reports = []
@@ -45,27 +43,141 @@ def update_search_index():
         # Did we already do this file? Compute a hash of the report JSON
         # (which includes the document hash) and use it as a cache key.
         cache_key = reportfn.replace(REPORTS_DIR, "reports") # old path
-        hasher = hashlib.sha1()
         with open(reportfn, 'rb') as f:
-            hasher.update(f.read())
-        cache_value = hasher.hexdigest()
+            cache_value = sha1_file(f)
         if cache.get(cache_key) == cache_value: continue
 
         reports.append((reportfn, cache_key, cache_value))
 
-    # Update index.
-    for reportfn, cache_key, cache_value in tqdm.tqdm(reports, "updating search index"):
-        # Push to index.
-        with open(reportfn) as f:
-            report = json.load(f)
-            update_search_index_for(report, index)
-
-        # Save to cache that we did this file & update cache (using a two-stage save).
-        cache[cache_key] = cache_value
-        json.dump(cache, open(INDEX_CACHE_FN + ".1", "w"))
-        os.rename(INDEX_CACHE_FN + ".1", INDEX_CACHE_FN)
+    # Nothing has changed since the last run, so there's nothing to push and
+    # the cache doesn't need to be rewritten.
+    if not reports:
+        return
 
-def update_search_index_for(report, index):
+    # Push index objects in batches, which takes one request per batch rather
+    # than one per report.
+    batch = []
+    def flush_batch():
+        # Push to index.
+        index.save_objects([index_data for index_data, cache_key, cache_value in batch])
+
+        # Save to cache that we did these files. Rather than rewriting the
+        # whole cache, append the new entries to the cache log.
+        for index_data, cache_key, cache_value in batch:
+            cache[cache_key] = cache_value
+            cache_log.write(orjson.dumps([cache_key, cache_value]) + b"\n")
+        cache_log.flush()
+
+        batch.clear()
+
+    # Update index. Reading each report and extracting its text is done in
+    # a multiprocessing pool to divide the load across processors, while the
+    # index objects are pushed to the index from this process.
+    with Pool() as pool, open(INDEX_CACHE_LOG_FN, "ab") as cache_log:
+        for item in tqdm.tqdm(pool.imap_unordered(load_index_data, reports, chunksize=8), "updating search index", total=len(reports)):
+            batch.append(item)
+            if len(batch) == INDEX_BATCH_SIZE:
+                flush_batch()
+        if batch:
+            flush_batch()
+
+    # Fold the log into the cache file.
+    save_index_cache(cache)
+
+def load_index_cache():
+    # The cache is stored as a JSON file mapping cache keys to values plus a
+    # log of newer entries, one JSON [key, value] pair per line, which are
+    # applied on top.
+    cache = { }
+    if os.path.exists(INDEX_CACHE_FN):
+        with open(INDEX_CACHE_FN, "rb") as f:
+            cache = orjson.loads(f.read())
+    if os.path.exists(INDEX_CACHE_LOG_FN):
+        with open(INDEX_CACHE_LOG_FN, "rb") as f:
+            for line in f:
+                try:
+                    cache_key, cache_value = orjson.loads(line)
+                except ValueError:
+                    continue # a partial line from an interrupted run
+                cache[cache_key] = cache_value
+    return cache
+
+def save_index_cache(cache):
+    # Write out the whole cache (using a two-stage save) and then clear the
+    # log, whose entries are now in the cache file.
+    with open(INDEX_CACHE_FN + ".1", "wb") as f:
+        f.write(orjson.dumps(cache))
+    os.rename(INDEX_CACHE_FN + ".1", INDEX_CACHE_FN)
+    if os.path.exists(INDEX_CACHE_LOG_FN):
+        os.unlink(INDEX_CACHE_LOG_FN)
+
+@functools.lru_cache(maxsize=4096)
+def format_index_date(s):
+    # Format a report date for display, e.g. "Jan. 2, 2020". Only the date
+    # part is displayed, so there's no need to parse a time or localize it
+    # to a timezone.
+    return datetime.date.fromisoformat(s[:10]).strftime("%b. %-d, %Y")
+
+def sha1_file(f):
+    # Hash a file without reading it into memory all at once. Python 3.11+
+    # has hashlib.file_digest, which reads into a reusable buffer.
+    if hasattr(hashlib, "file_digest"):
+        return hashlib.file_digest(f, "sha1").hexdigest()
+    hasher = hashlib.sha1()
+    for chunk in iter(lambda : f.read(65536), b""):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+def load_index_data(task):
+    # Load a report and make its index object in a pool worker. Only
+    # file names and the resulting dicts cross process boundaries.
+    reportfn, cache_key, cache_value = task
+    with open(reportfn, "rb") as f:
+        report = orjson.loads(f.read())
+    return make_index_data(report), cache_key, cache_value
+
+class TextCollector:
+    # An lxml parser target that collects the text of a document as it is
+    # parsed, without building a tree.
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+    def data(self, text):
+        self.chunks.append(text)
+        self.length += len(text)
+    def close(self):
+        return "".join(self.chunks)
+
+def read_report_text(html_fn, max_length):
+    # Get (at least) the first max_length characters of the plain text of a
+    # cleaned report HTML file. process_incoming writes the text to a .txt
+    # file alongside the HTML, so use that if it's there rather than parsing
+    # the HTML.
+    try:
+        with open(os.path.splitext(html_fn)[0] + ".txt") as f:
+            return f.read(max_length)
+    except FileNotFoundError:
+        pass
+
+    try:
+        with open(html_fn) as f:
+            # Parse the page with lxml's HTML parser, which is written in C.
+            # These are our own cleaned report pages, so we don't need
+            # html5lib's strict HTML5 parsing. The file is decoded as text
+            # first because the pages don't declare their encoding. Rather
+            # than building a tree, collect the text as it's parsed, and stop
+            # reading the file once we have enough.
+            collector = TextCollector()
+            parser = lxml.etree.HTMLParser(target=collector)
+            while collector.length < max_length:
+                chunk = f.read(65536)
+                if not chunk: break
+                parser.feed(chunk)
+            return parser.close()
+    except (FileNotFoundError, ValueError, lxml.etree.LxmlError):
+        return None # print("Missing/invalid HTML", html_fn)
+
+def make_index_data(report):
     # Find the most recent HTML text, which we'll use for indexing.
     text_fn = None
     text = None
@@ -73,25 +185,13 @@ def update_search_index_for(report, index):
         for versionformat in version["formats"]:
             if versionformat["format"] == "HTML":
                 text_fn = os.path.join("reports", versionformat['filename'])
-    if text_fn:
-        try:
-            with open(text_fn) as f:
-                # Parse the page as HTML5. html5lib gives some warnings about malformed
-                # content that we don't care about -- hide warnings.
-                import warnings
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    dom = html5lib.parse(f.read(), treebuilder="lxml")
-
-                # Convert to plain text.
-                text = lxml.etree.tostring(dom, method='text', encoding=str)
-        except (FileNotFoundError, ValueError):
-            pass # print("Missing/invalid HTML", report["number"], version["date"])
 
     # There's a quota on the size of the index_data, 10KB minified JSON
     # according to the docs, although we seem to be able to push more
     # than that. Limit the amount of text we send up.
     max_text_length = 13000 - len(report["versions"][0]["title"]) - len(report["topics"])
+    if text_fn:
+        text = read_report_text(text_fn, max_text_length)
     summary = (report["versions"][0].get("summary") or "")[0:max_text_length]
     if text:
         text = text[:(max_text_length - len(summary))]
@@ -106,7 +206,7 @@ def update_search_index_for(report, index):
         "firstPubDate": report["versions"][-1]["date"],
         "lastPubYear": int(report["versions"][0]["date"][0:4]),
         "firstPubYear": int(report["versions"][-1]["date"][0:4]),
-        "date": parse_dt(report["versions"][0]["date"]).strftime("%b. %-d, %Y"),
+        "date": format_index_date(report["versions"][0]["date"]),
         "summary": summary,
         "topics": report["topics"],
         "isUpdated": len(report["versions"]) > 1,
@@ -114,10 +214,10 @@ def update_search_index_for(report, index):
         "url": "https://www.everycrsreport.com/reports/%s.html" % report["number"],
     }
 
-    #print(json.dumps(index_data, indent=2))
+    #print(orjson.dumps(index_data, option=orjson.OPT_INDENT_2).decode())
     #print()
 
-    index.save_object(index_data)
+    return index_data
 
 if __name__ == "__main__":
     update_search_index()
@@ -1,36 +1,137 @@
 import datetime
+import errno
+import functools
 import os
 import os.path
+import stat
+import zoneinfo
 
-import pytz
-
-us_eastern_tz = pytz.timezone('America/New_York')
-utc_tz = pytz.timezone("UTC")
+us_eastern_tz = zoneinfo.ZoneInfo('America/New_York')
+utc_tz = datetime.timezone.utc
 
 def make_link(src, dst):
     # Make a hard link dst to source if the paths are on the same filesystem,
     # or a symbolic link if they are not. If dst exists and isn't a link to
-    # src, it is deleted first. If src is None and dst exists, dst is deleted.
+    # src, it is replaced. If src is None and dst exists, dst is deleted.
     #
     # Use l* functions so this doesn't break with broken symlinks (exists()
     # and stat() raise exceptions on broken symlinks).
-    if os.path.lexists(dst):
-        if src and os.lstat(src).st_ino == os.lstat(dst).st_ino:
+
+    # Try making the hard link first. In the common case, where dst doesn't
+    # exist yet and the paths are on the same filesystem, that's the only
+    # system call needed.
+    if src:
+        try:
+            os.link(src, dst)
+            return
+        except FileExistsError:
+            pass # see what's there below
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # The paths are on different filesystems. A symlink is made below.
+
+    src_stat = os.lstat(src) if src else None
+
+    # A single lstat both checks whether dst exists and gets what's needed
+    # to compare it with src.
+    try:
+        dst_stat = os.lstat(dst)
+    except FileNotFoundError:
+        dst_stat = None
+
+    if dst_stat is not None:
+        if src and os.path.samestat(src_stat, dst_stat):
             return # files are already hardlinked
-        if src and os.path.exists(os.path.realpath(dst)) and os.lstat(src).st_ino == os.lstat(os.path.realpath(dst)).st_ino:
-            return # files are already symlinked
+        # Only a symlink can resolve to somewhere else, so skip the path walk
+        # in realpath for regular files.
+        real_dst = os.path.realpath(dst) if stat.S_ISLNK(dst_stat.st_mode) else dst
+        if src and real_dst != dst:
+            try:
+                if os.path.samestat(src_stat, os.lstat(real_dst)):
+                    return # files are already symlinked
+            except OSError:
+                pass # broken symlink
         # Destination exists and is not a link to src.
-        #raise ValueError(f"Should {dst} be deleted? It's not a hard link to {src} and its symbolic target is {os.path.realpath(dst)}.")
-        print(f"Deleting {dst}... ({os.path.realpath(dst)} != {src})")
-        os.unlink(dst)
+        #raise ValueError(f"Should {dst} be deleted? It's not a hard link to {src} and its symbolic target is {real_dst}.")
+        print(f"{'Replacing' if src else 'Deleting'} {dst}... ({real_dst} != {src})")
+        if not src:
+            os.unlink(dst)
+            return
+
     if src:
-       # Create a hard link if paths are on the same filesystem.
-       if os.lstat(src).st_dev == os.lstat(os.path.dirname(dst)).st_dev:
-           os.link(src, dst)
-       # Otherwise when crossing filesystem boundaries, use a symlink.
-       else:
-           os.symlink(os.path.abspath(src), dst)
+        # If dst exists, make the new link beside it and then rename it over
+        # dst, so that dst is replaced atomically and never goes missing.
+        link_fn = dst
+        if dst_stat is not None:
+            link_fn = dst + ".link.tmp"
+            try:
+                os.unlink(link_fn) # left over from an interrupted run
+            except FileNotFoundError:
+                pass
+
+        # Create a hard link, or when crossing filesystem boundaries, a symlink.
+        try:
+            os.link(src, link_fn)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            os.symlink(os.path.abspath(src), link_fn)
+
+        if link_fn != dst:
+            os.replace(link_fn, dst)
 
+# The strptime formats for parse_dt, by whether the string has a time and
+# whether it has microseconds.
+DT_FORMATS = {
+    (False, False): "%Y-%m-%d",
+    (False, True): "%Y-%m-%d.%f",
+    (True, False): "%Y-%m-%dT%H:%M:%S",
+    (True, True): "%Y-%m-%dT%H:%M:%S.%f",
+}
+
+# The same dates are parsed many times over while building the site, and
+# datetimes are immutable, so the results are cached.
+@functools.lru_cache(maxsize=4096)
 def parse_dt(s, hasmicro=False, utc=False):
-    dt = datetime.datetime.strptime(s, "%Y-%m-%d" + ("T%H:%M:%S" if "T" in s else "") + (".%f" if hasmicro else ""))
-    return (utc_tz if utc else us_eastern_tz).localize(dt)
+    dt = parse_dt_fields(s, hasmicro)
+    if dt is None:
+        # Not in the expected layout. strptime will raise a useful error.
+        dt = datetime.datetime.strptime(s, DT_FORMATS[("T" in s, hasmicro)])
+    # fold=1 resolves the repeated hour when DST ends to standard time, which
+    # matches pytz's localize. It doesn't match for times in the hour skipped
+    # when DST starts: pytz gave those standard time (-05:00), but fold=1
+    # gives daylight time (-04:00). Also, per PEP 495, datetimes in the
+    # repeated hour compare unequal to those from other tzinfo objects, such
+    # as pytz's, even when their UTC offsets match.
+    return dt.replace(tzinfo=utc_tz if utc else us_eastern_tz, fold=1)
+
+def parse_dt_fields(s, hasmicro):
+    # Parse a string in one of the DT_FORMATS by slicing out its fields, which
+    # is much faster than strptime. Returns None if the string isn't laid out
+    # as expected.
+    if not s.isascii() or len(s) < 10 or s[4] != "-" or s[7] != "-":
+        return None
+    fields = [s[0:4], s[5:7], s[8:10]]
+    rest = s[10:]
+    if "T" in s:
+        if len(rest) < 9 or rest[0] != "T" or rest[3] != ":" or rest[6] != ":":
+            return None
+        fields += [rest[1:3], rest[4:6], rest[7:9]]
+        rest = rest[9:]
+    else:
+        fields += ["0", "0", "0"]
+    if hasmicro:
+        if not (2 <= len(rest) <= 7) or rest[0] != ".":
+            return None
+        fields.append(rest[1:].ljust(6, "0"))
+    elif rest:
+        return None
+    else:
+        fields.append("0")
+    if not all(field.isdigit() for field in fields):
+        return None
+    try:
+        return datetime.datetime(*map(int, fields))
+    except ValueError:
+        return None # out of range, e.g. a 13th month